@@ -1,22 +1,83 @@
 # Modified app/classification.py for Gemini API
 
 import google.generativeai as genai
-import json
+import asyncio
+import heapq
+import orjson
+import os
 import re
+import time
 import logging
-from typing import List, Dict, Tuple
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple
+from google.api_core.exceptions import GoogleAPIError
+from pydantic import ValidationError
 from .models import ClassificationOutput, ClassifiedAmount
-from .prompts import get_classification_prompt
+from .prompts import get_classification_prompt, PROMPT_VERSION
+from .classification_cache import ClassificationCache
 
 logger = logging.getLogger(__name__)
 
+def _extract_json_object(text: str) -> Optional[str]:
+    """
+    Return the first balanced {...} object in text, or None if there is none.
+    
+    Single pass tracking brace depth; braces inside JSON strings are ignored,
+    so trailing commentary after the object is never included.
+    """
+    start = -1
+    depth = 0
+    in_string = False
+    escaped = False
+    
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            if depth:
+                in_string = True
+        elif char == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    
+    return None
+
+def _is_source_quote(context: Optional[str]) -> bool:
+    """True if a classification context already quotes the source text"""
+    return isinstance(context, str) and context.startswith("text: '")
+
 class GeminiClassificationService:
     """Service to classify amounts using Google Gemini API"""
     
     def __init__(self, gemini_api_key: str):
         """Initialize classification service with Gemini API"""
         genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash')
+        self.model_name = 'gemini-2.0-flash'
+        self.model = genai.GenerativeModel(self.model_name)
+        
+        # On-disk cache of Gemini results, keyed by model + prompt version + text
+        self.cache = ClassificationCache(os.getenv("CACHE_DIR", ".cache/classification"))
+        
+        # Total Gemini calls per document when the response cannot be parsed
+        self.max_gemini_attempts = 3
+        
+        # Short documents with few amounts skip Gemini; SKIP_LLM_BELOW=0 disables this
+        self.skip_llm_below_chars = int(os.getenv("SKIP_LLM_BELOW", "200"))
+        self.skip_llm_max_amounts = 2
+        
+        # Gemini calls in flight, keyed by text: concurrent requests for the same
+        # document share one call instead of each paying for their own
+        self._inflight: Dict[str, asyncio.Task] = {}
         
         # Classification categories as per problem statement
         self.amount_types = [
@@ -35,26 +96,75 @@ class GeminiClassificationService:
             'medicine': ['medicine', 'drug', 'tablet', 'capsule', 'prescription', 'pharmacy'],
             'test': ['test', 'lab', 'report', 'scan', 'x-ray', 'blood', 'urine', 'pathology']
         }
-
-    def extract_context_windows(self, text: str, amounts: List[float], window_size: int = 50) -> Dict[float, str]:
-        """Extract surrounding context for each amount"""
-        contexts = {}
         
-        for amount in amounts:
-            # Convert amount to possible string representations
-            amount_strings = [
+        # Flat keyword -> category lookup, built once
+        self._keyword_to_category = {
+            keyword: category
+            for category, keywords in self.keyword_mapping.items()
+            for keyword in keywords
+        }
+        self._all_keywords = frozenset(self._keyword_to_category)
+        
+        # Single automaton-style pattern over every keyword. The lookahead reports
+        # overlapping hits (e.g. "total" inside "grand total") in one scan. Hits
+        # are plain substrings, as with the original `keyword in text` checks, so
+        # "off" still matches inside "office".
+        self._keyword_pattern = re.compile(
+            "(?=(" + "|".join(map(re.escape, sorted(self._all_keywords, key=len, reverse=True))) + "))"
+        )
+        
+        # Compiled amount patterns for context extraction, keyed by amount
+        self._pattern_cache: Dict[float, Tuple[re.Pattern, ...]] = {}
+        self.max_pattern_cache_size = 1024
+        
+        # Type combinations typical of medical bills: total + paid, total + due,
+        # consultation + medicine, total + tax
+        self._good_patterns = [
+            frozenset(pattern) for pattern in (
+                ('total_bill', 'paid'),
+                ('total_bill', 'due'),
+                ('consultation', 'medicine'),
+                ('total_bill', 'tax')
+            )
+        ]
+
+    def _get_amount_patterns(self, amount: float) -> Tuple[re.Pattern, ...]:
+        """Compiled patterns for each string representation of an amount, in preference order"""
+        patterns = self._pattern_cache.get(amount)
+        if patterns is None:
+            # Convert amount to possible string representations (duplicates dropped,
+            # order kept: it decides ties between equally long contexts)
+            amount_strings = dict.fromkeys((
                 str(int(amount)),  # 1200
                 str(amount),       # 1200.0
                 f"{amount:.2f}",   # 1200.00
                 f"{int(amount):,}" if amount >= 1000 else str(int(amount))  # 1,200
-            ]
+            ))
+            patterns = tuple(re.compile(re.escape(amount_str)) for amount_str in amount_strings)
             
+            if len(self._pattern_cache) >= self.max_pattern_cache_size:
+                self._pattern_cache.clear()
+            self._pattern_cache[amount] = patterns
+        
+        return patterns
+
+    def extract_context_windows(self, text: str, amounts: List[float], window_size: int = 50) -> Dict[float, str]:
+        """
+        Extract surrounding context for each amount
+        
+        Only the rule-based fallback needs this; the Gemini path sends the whole
+        text in the prompt and never builds context windows.
+        """
+        contexts = {}
+        
+        for amount in amounts:
             best_context = ""
             best_match_length = 0
             
-            for amount_str in amount_strings:
-                # Find all occurrences of this amount string
-                for match in re.finditer(re.escape(amount_str), text):
+            # The longest context wins; ties go to the earlier representation,
+            # then to the earlier occurrence
+            for pattern in self._get_amount_patterns(amount):
+                for match in pattern.finditer(text):
                     start_pos = match.start()
                     end_pos = match.end()
                     
@@ -72,57 +182,107 @@ class GeminiClassificationService:
         
         return contexts
 
-    def create_gemini_prompt(self, text: str, amounts: List[float], contexts: Dict[float, str]) -> str:
+    def create_gemini_prompt(self, text: str) -> str:
         """Create a well-structured prompt for Gemini"""
         return get_classification_prompt(text)
 
-    def classify_with_gemini(self, text: str) -> List[ClassifiedAmount]:
-        """Use Gemini to classify amounts based on context"""
+    def parse_gemini_response(self, response_content: str) -> List[ClassifiedAmount]:
+        """Parse Gemini's JSON response into ClassifiedAmount objects"""
         
-        try:
-            # Create prompt
-            prompt = self.create_gemini_prompt(text, [], {})
+        # Clean response (remove any non-JSON content)
+        json_content = _extract_json_object(response_content)
+        
+        if json_content is None:
+            # Unbalanced braces: fall back to the outermost-brace heuristic
+            json_start = response_content.find('{')
+            json_end = response_content.rfind('}') + 1
+            
+            if json_start == -1 or json_end <= json_start:
+                logger.warning("Gemini response does not contain valid JSON")
+                raise ValueError("Invalid Gemini response format")
             
-            logger.info(f"Sending classification request to Gemini for text analysis")
+            json_content = response_content[json_start:json_end]
+        
+        classification_result = orjson.loads(json_content)
+        
+        # Extract amounts array from the response
+        amounts_array = classification_result.get('amounts', [])
+        
+        # Convert to ClassifiedAmount objects
+        classified_amounts = []
+        for item in amounts_array:
+            if isinstance(item, dict) and 'value' in item and 'type' in item:
+                context = item.get('source', item.get('context', 'Gemini classification'))
+                classified_amounts.append(ClassifiedAmount(
+                    type=item['type'],
+                    value=float(item['value']),
+                    context=context,
+                    name=item.get('name', None),
+                    has_source=_is_source_quote(context)
+                ))
+        
+        return classified_amounts
+
+    def classify_with_gemini(self, text: str) -> List[ClassifiedAmount]:
+        """
+        Use Gemini to classify amounts based on context
+        
+        Malformed responses are sent back to Gemini with the parse error so it can
+        correct itself; only after max_gemini_attempts does the error propagate.
+        Failures are not logged here: the caller logs them once as it falls back.
+        """
+        
+        # Serve repeated documents from the cache instead of calling Gemini again
+        cache_key = self.cache.make_key(self.model_name, PROMPT_VERSION, text)
+        cached_amounts = self.cache.get(cache_key)
+        if cached_amounts is not None:
+            try:
+                # has_source is not serialized, so it is derived again from the context
+                classified_amounts = [
+                    ClassifiedAmount(**item, has_source=_is_source_quote(item.get('context')))
+                    for item in cached_amounts
+                ]
+                logger.info(f"Using cached Gemini classification ({len(classified_amounts)} amounts)")
+                return classified_amounts
+            except (AttributeError, TypeError, ValidationError) as e:
+                logger.warning(f"Ignoring invalid classification cache entry: {e}")
+        
+        # Create prompt
+        prompt = self.create_gemini_prompt(text)
+        contents = prompt
+        
+        for attempt in range(self.max_gemini_attempts):
+            logger.info(f"Sending classification request to Gemini for text analysis (attempt {attempt + 1})")
             
             # Call Gemini API
-            response = self.model.generate_content(prompt)
+            response = self.model.generate_content(contents)
             
             # Parse response
             response_content = response.text.strip()
             
-            # Clean response (remove any non-JSON content)
-            json_start = response_content.find('{')
-            json_end = response_content.rfind('}') + 1
-            
-            if json_start != -1 and json_end != -1:
-                json_content = response_content[json_start:json_end]
-                classification_result = json.loads(json_content)
-                
-                # Extract amounts array from the response
-                amounts_array = classification_result.get('amounts', [])
+            try:
+                classified_amounts = self.parse_gemini_response(response_content)
+            except (ValueError, TypeError, ValidationError) as e:
+                if attempt + 1 >= self.max_gemini_attempts:
+                    raise
                 
-                # Convert to ClassifiedAmount objects
-                classified_amounts = []
-                for item in amounts_array:
-                    if isinstance(item, dict) and 'value' in item and 'type' in item:
-                        classified_amounts.append(ClassifiedAmount(
-                            type=item['type'],
-                            value=float(item['value']),
-                            context=item.get('source', item.get('context', 'Gemini classification')),
-                            name=item.get('name', None)
-                        ))
+                logger.warning(f"Gemini returned invalid output (attempt {attempt + 1}): {e}, retrying with feedback")
+                time.sleep(1.0 * (attempt + 1))
                 
-                logger.info(f"Gemini successfully classified {len(classified_amounts)} amounts")
-                return classified_amounts
+                # Continue the conversation so Gemini sees its own output and the error
+                contents = [
+                    {"role": "user", "parts": [prompt]},
+                    {"role": "model", "parts": [response_content]},
+                    {"role": "user", "parts": [
+                        f"Your previous output had error: {e}. Return only valid JSON matching the schema."
+                    ]},
+                ]
+                continue
             
-            else:
-                logger.warning("Gemini response does not contain valid JSON")
-                raise ValueError("Invalid Gemini response format")
-                
-        except Exception as e:
-            logger.error(f"Gemini classification failed: {e}")
-            raise
+            logger.info(f"Gemini successfully classified {len(classified_amounts)} amounts")
+            
+            self.cache.set(cache_key, [item.model_dump() for item in classified_amounts])
+            return classified_amounts
 
     def fallback_rule_based_classification(self, text: str, amounts: List[float]) -> List[ClassifiedAmount]:
         """Rule-based fallback classification when Gemini fails"""
@@ -135,41 +295,49 @@ class GeminiClassificationService:
         # Extract context for each amount
         contexts = self.extract_context_windows(text, amounts, window_size=30)
         
+        # Largest and second-largest amounts for the pattern rules, found once in O(n)
+        top_amounts = heapq.nlargest(2, amounts)
+        max_amount = top_amounts[0] if top_amounts else None
+        second_amount = top_amounts[1] if len(top_amounts) > 1 else None
+        
+        # Keywords anywhere in the document are found once, not once per amount.
+        # Document and context window are scanned separately, so a multi-word
+        # keyword never straddles the end of the text and the start of a window
+        document_keywords = dict.fromkeys(
+            match.group(1) for match in self._keyword_pattern.finditer(text_lower)
+        )
+        
         for amount in amounts:
             context = contexts.get(amount, "").lower()
-            combined_text = (text_lower + " " + context).lower()
             
-            # Classify based on keyword matching
-            classified_type = "other"  # Default
-            confidence_score = 0.0
-            reasoning = "rule-based classification"
+            # Give higher weight to keywords found near the amount (inside the context window)
+            keyword_weights = dict.fromkeys(document_keywords, 1)
+            for match in self._keyword_pattern.finditer(context):
+                keyword_weights[match.group(1)] = 2
             
-            # Check each category
-            for category, keywords in self.keyword_mapping.items():
-                category_score = 0
-                matched_keywords = []
-                
-                for keyword in keywords:
-                    if keyword in combined_text:
-                        # Give higher weight to keywords found near the amount
-                        if keyword in context:
-                            category_score += 2
-                            matched_keywords.append(keyword)
-                        else:
-                            category_score += 1
-                            matched_keywords.append(keyword)
-                
-                # Select category with highest score
-                if category_score > confidence_score:
-                    confidence_score = category_score
-                    classified_type = category
-                    reasoning = f"matched keywords: {', '.join(matched_keywords)}"
+            # Score categories from the hits via the keyword -> category lookup
+            category_scores = dict.fromkeys(self.keyword_mapping, 0)
+            matched_keywords = defaultdict(list)
+            for keyword, weight in keyword_weights.items():
+                category = self._keyword_to_category[keyword]
+                category_scores[category] += weight
+                matched_keywords[category].append(keyword)
+            
+            # Select category with highest score (ties go to the earlier category)
+            best_category = max(category_scores, key=category_scores.get)
+            if category_scores[best_category] > 0:
+                classified_type = best_category
+                reasoning = f"matched keywords: {', '.join(matched_keywords[best_category])}"
+            else:
+                classified_type = "other"  # Default
+                reasoning = "rule-based classification"
             
             # Special logic for amount patterns
             if classified_type == "other":
-                classified_type, reasoning = self._apply_amount_pattern_rules(amount, amounts, text_lower)
+                classified_type, reasoning = self._apply_amount_pattern_rules(amount, max_amount, second_amount)
             
-            classified_amounts.append(ClassifiedAmount(
+            # Type and value come from our own rules, so skip validation
+            classified_amounts.append(ClassifiedAmount.model_construct(
                 type=classified_type,
                 value=amount,
                 context=reasoning,
@@ -178,11 +346,19 @@ class GeminiClassificationService:
         
         return classified_amounts
 
-    def _apply_amount_pattern_rules(self, amount: float, all_amounts: List[float], text: str) -> Tuple[str, str]:
-        """Apply pattern-based rules for classification"""
+    def _apply_amount_pattern_rules(self, amount: float, max_amount: float,
+                                    second_amount: Optional[float]) -> Tuple[str, str]:
+        """
+        Apply pattern-based rules for classification
+        
+        Args:
+            amount: The amount to classify
+            max_amount: Largest amount in the document
+            second_amount: Second-largest amount, or None if there is only one amount
+        """
         
         # If it's the largest amount, likely total
-        if amount == max(all_amounts) and len(all_amounts) > 1:
+        if amount == max_amount and second_amount is not None:
             return "total_bill", "largest amount in document"
         
         # If it's a round number and largest, likely total
@@ -194,10 +370,8 @@ class GeminiClassificationService:
             return "consultation", "small amount pattern"
         
         # If multiple amounts and this is second largest, might be paid amount
-        if len(all_amounts) > 1:
-            sorted_amounts = sorted(all_amounts, reverse=True)
-            if amount == sorted_amounts[1]:
-                return "paid", "second largest amount"
+        if second_amount is not None and amount == second_amount:
+            return "paid", "second largest amount"
         
         return "other", "no clear pattern identified"
 
@@ -212,68 +386,152 @@ class GeminiClassificationService:
         # Base confidence depends on method used
         base_confidence = 0.8 if used_gemini else 0.6
         
+        # Collect the types found and count "other" in a single pass
+        found_types = set()
+        other_count = 0
+        for item in classified_amounts:
+            found_types.add(item.type)
+            if item.type == "other":
+                other_count += 1
+        
         # Boost confidence if we have variety in classifications
-        unique_types = len(set(item.type for item in classified_amounts))
-        if unique_types > 1:
+        if len(found_types) > 1:
             base_confidence += 0.1
         
         # Boost confidence if we have common medical bill patterns
-        types_found = [item.type for item in classified_amounts]
-        
-        # Good patterns: total + paid, total + due, consultation + medicine
-        good_patterns = [
-            ['total_bill', 'paid'],
-            ['total_bill', 'due'],
-            ['consultation', 'medicine'],
-            ['total_bill', 'tax']
-        ]
-        
-        for pattern in good_patterns:
-            if all(t in types_found for t in pattern):
+        for pattern in self._good_patterns:
+            if pattern <= found_types:
                 base_confidence += 0.05
         
         # Penalty if too many "other" classifications
-        other_count = sum(1 for item in classified_amounts if item.type == "other")
         if other_count > len(classified_amounts) * 0.5:  # More than 50% are "other"
             base_confidence -= 0.2
         
         return min(base_confidence, 1.0)
 
+    def build_classification_output(self,
+                                    classified_amounts: List[ClassifiedAmount],
+                                    used_gemini: bool) -> ClassificationOutput:
+        """Score classified amounts and wrap them in the Step 3 output schema"""
+        
+        # Calculate confidence
+        confidence = self.calculate_classification_confidence(classified_amounts, used_gemini)
+        
+        logger.info(f"Classification completed: {len(classified_amounts)} amounts classified with confidence {confidence:.2f}")
+        
+        # Create output following exact schema
+        return ClassificationOutput(
+            amounts=classified_amounts,
+            confidence=round(confidence, 2)
+        )
+
+    def should_skip_gemini(self, text: str, amounts: List[float]) -> bool:
+        """Trivially small documents are classified well enough by the rule-based path"""
+        return len(amounts) <= self.skip_llm_max_amounts and len(text) < self.skip_llm_below_chars
+
+    def _start_classification(self, text: str, amounts: List[float]) -> bool:
+        """Log the start of Step 3; True if the document goes straight to the rule-based path"""
+        logger.info(f"Starting classification of text with {len(amounts)} amounts")
+        
+        if self.should_skip_gemini(text, amounts):
+            logger.info("Short document, skipping Gemini")
+            return True
+        return False
+
+    def _log_gemini_fallback(self, error: Exception) -> None:
+        """Log a Gemini failure before falling back to rules"""
+        # Quota/network errors and malformed output are expected and fall back
+        # quietly; only anything else pays for a traceback
+        expected = isinstance(error, (GoogleAPIError, TimeoutError, ValueError, TypeError))
+        logger.warning(f"Gemini classification failed: {error}, using rule-based fallback", exc_info=not expected)
+
+    def _classification_error(self, error: Exception) -> ValueError:
+        """Log an unexpected Step 3 failure and wrap it for the API layer"""
+        logger.error(f"Classification processing error: {error}")
+        return ValueError(f"Classification failed: {str(error)}")
+
     def process_amounts(self, text: str, amounts: List[float]) -> ClassificationOutput:
         """
         Main processing method for Step 3: Classification by Context
+        Blocking variant of process_amounts_async for callers without an event loop.
         """
         try:
-            logger.info(f"Starting classification of text with {len(amounts)} amounts")
-            
-            classified_amounts = []
-            used_gemini = False
+            if self._start_classification(text, amounts):
+                classified_amounts = self.fallback_rule_based_classification(text, amounts)
+                return self.build_classification_output(classified_amounts, used_gemini=False)
             
             try:
-                # Try Gemini classification first (now analyzes entire text)
+                # Try Gemini classification first (analyzes the entire text)
                 classified_amounts = self.classify_with_gemini(text)
                 used_gemini = True
                 
             except Exception as e:
-                logger.warning(f"Gemini classification failed: {e}, using rule-based fallback")
+                self._log_gemini_fallback(e)
                 classified_amounts = self.fallback_rule_based_classification(text, amounts)
                 used_gemini = False
             
-            # Calculate confidence
-            confidence = self.calculate_classification_confidence(classified_amounts, used_gemini)
+            return self.build_classification_output(classified_amounts, used_gemini)
             
-            logger.info(f"Classification completed: {len(classified_amounts)} amounts classified with confidence {confidence:.2f}")
+        except Exception as e:
+            raise self._classification_error(e)
+
+    async def close(self) -> None:
+        """Cancel in-flight Gemini calls so no request is left waiting on shutdown"""
+        tasks = list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._inflight.clear()
+
+    async def classify_with_gemini_async(self, text: str) -> List[ClassifiedAmount]:
+        """
+        Classify text in a worker thread, joining the call already in flight for
+        the same text if there is one
+        
+        Each caller is released as soon as its own document is classified.
+        """
+        task = self._inflight.get(text)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self.classify_with_gemini, text))
+            self._inflight[text] = task
+            task.add_done_callback(lambda done: self._finish_inflight(text, done))
+        
+        # Shielded so one cancelled caller does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, text: str, task: asyncio.Task) -> None:
+        """Forget a finished call; its outcome is delivered to the waiting callers"""
+        if self._inflight.get(text) is task:
+            del self._inflight[text]
+        
+        # Mark the exception retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def process_amounts_async(self, text: str, amounts: List[float]) -> ClassificationOutput:
+        """
+        Main processing method for Step 3, used by the API endpoints
+        Same steps as process_amounts; Gemini and the rule-based fallback run in
+        worker threads, off the event loop.
+        """
+        try:
+            if self._start_classification(text, amounts):
+                classified_amounts = await asyncio.to_thread(self.fallback_rule_based_classification, text, amounts)
+                return self.build_classification_output(classified_amounts, used_gemini=False)
             
-            # Create output following exact schema
-            result = ClassificationOutput(
-                amounts=classified_amounts,
-                confidence=round(confidence, 2)
-            )
+            try:
+                # Try Gemini classification first (analyzes the entire text)
+                classified_amounts = await self.classify_with_gemini_async(text)
+                used_gemini = True
+                
+            except Exception as e:
+                self._log_gemini_fallback(e)
+                classified_amounts = await asyncio.to_thread(self.fallback_rule_based_classification, text, amounts)
+                used_gemini = False
             
-            return result
+            return self.build_classification_output(classified_amounts, used_gemini)
             
         except Exception as e:
-            logger.error(f"Classification processing error: {e}")
-            raise ValueError(f"Classification failed: {str(e)}")
+            raise self._classification_error(e)
 
 # Note: This service will be instantiated in main.py with the Gemini API key
\ No newline at end of file
@@ -0,0 +1,153 @@
+# app/classification_cache.py
+"""
+On-disk cache for Gemini classification results
+Content-addressable: entries are keyed by model, prompt version and input text
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Cached classifications expire after one week
+DEFAULT_TTL_SECONDS = 7 * 86400
+
+# Entries kept on disk at most; the oldest beyond this are deleted by sweep()
+DEFAULT_MAX_ENTRIES = 10000
+
+# Writes between sweeps (the first write of a process always sweeps)
+SWEEP_EVERY_WRITES = 100
+
+
+class ClassificationCache:
+    """JSON-file cache mapping (model, prompt version, text) to classified amounts"""
+
+    def __init__(self, cache_dir: str, ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        """Initialize cache rooted at cache_dir"""
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._writes_since_sweep = SWEEP_EVERY_WRITES - 1
+        self._counter_lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name: str, prompt_version: str, text: str) -> str:
+        """
+        Build the cache key for a classification request
+
+        Each part is length-prefixed (8 bytes) so that different splits of the
+        same bytes can never collide.
+        """
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_version, text):
+            data = part.encode("utf-8")
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _path_for(self, key: str) -> str:
+        """Shard entries by the first two hex characters of the key"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _remove(self, path: str) -> None:
+        """Delete a cache file; a concurrent delete is not an error"""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete classification cache file {path}: {e}")
+
+    def get(self, key: str) -> Optional[List[Any]]:
+        """Return the cached amounts for key, or None on miss/expiry
+
+        Expired and malformed entries are deleted, so they never linger on disk.
+        """
+        path = self._path_for(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Dropping malformed classification cache entry {key}: {e}")
+            self._remove(path)
+            return None
+        except OSError as e:
+            logger.warning(f"Could not read classification cache entry {key}: {e}")
+            return None
+
+        created = entry.get("created") if isinstance(entry, dict) else None
+        if not isinstance(created, (int, float)) or time.time() - created > self.ttl_seconds:
+            self._remove(path)
+            return None
+
+        return entry.get("amounts")
+
+    def set(self, key: str, amounts: List[Any]) -> None:
+        """Store amounts under key; failures are logged and otherwise ignored"""
+        path = self._path_for(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write to a temp file first so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"created": time.time(), "amounts": amounts}, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        except OSError as e:
+            logger.warning(f"Could not write classification cache entry {key}: {e}")
+            return
+
+        # Only successful writes count; set() runs on several worker threads, so
+        # the counter is updated under a lock to keep the cadence exact
+        with self._counter_lock:
+            self._writes_since_sweep += 1
+            sweep_due = self._writes_since_sweep >= SWEEP_EVERY_WRITES
+            if sweep_due:
+                self._writes_since_sweep = 0
+
+        if sweep_due:
+            self.sweep()
+
+    def sweep(self) -> None:
+        """Delete expired entries, then the oldest entries beyond max_entries"""
+        if not self._sweep_lock.acquire(blocking=False):
+            return  # Another thread is already sweeping
+
+        try:
+            # Files are written once (atomic replace), so mtime is the creation time
+            cutoff = time.time() - self.ttl_seconds
+            live = []
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        mtime = os.path.getmtime(path)
+                    except OSError:
+                        continue
+
+                    # Expired entries and temp files left behind by crashed writers
+                    if mtime < cutoff:
+                        self._remove(path)
+                    elif name.endswith(".json"):
+                        live.append((mtime, path))
+
+            if len(live) > self.max_entries:
+                live.sort()
+                for _, path in live[:len(live) - self.max_entries]:
+                    self._remove(path)
+        finally:
+            self._sweep_lock.release()
@@ -4,13 +4,17 @@ Main FastAPI application for Medical Amount Detection
 Implements the complete 4-step pipeline as per problem statement
 """
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
+import asyncio
 import logging
 import os
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Union, Optional
 from dotenv import load_dotenv
@@ -36,13 +40,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Global variables for services
+classification_service = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize services on startup and stop background workers on shutdown"""
+    global classification_service
+    
+    # Get Gemini API key instead of OpenAI
+    gemini_api_key = os.getenv("GEMINI_API_KEY")
+    if not gemini_api_key:
+        logger.error("GEMINI_API_KEY environment variable not set!")
+        raise ValueError("Gemini API key is required")
+    
+    # Blocking pipeline steps run in the default executor; size it for concurrent requests
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=32))
+    
+    # Initialize with Gemini classification service
+    classification_service = GeminiClassificationService(gemini_api_key)
+    
+    # Pre-warm the Gemini client (DNS, TLS, model setup) so the first real request is fast
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(classification_service.model.generate_content, "ping"),
+            timeout=10
+        )
+        logger.info("Gemini connection pre-warmed")
+    except Exception as e:
+        logger.warning(f"Gemini pre-warm failed: {e}")
+    
+    logger.info("Medical Amount Detection API started successfully with Gemini")
+    
+    yield
+    
+    await classification_service.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Medical Amount Detection API",
     description="AI-powered service that extracts financial amounts from medical bills and receipts",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -54,25 +96,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global variables for services
-classification_service = None
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize services on startup"""
-    global classification_service
-    
-    # Get Gemini API key instead of OpenAI
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    if not gemini_api_key:
-        logger.error("GEMINI_API_KEY environment variable not set!")
-        raise ValueError("Gemini API key is required")
-    
-    # Initialize with Gemini classification service
-    classification_service = GeminiClassificationService(gemini_api_key)
-    
-    logger.info("Medical Amount Detection API started successfully with Gemini")
-
 # Dependency to get classification service
 # Update the type hint (CHANGED)
 def get_classification_service():
@@ -82,13 +105,14 @@ def get_classification_service():
     return classification_service
 
 # Helper function to validate file upload
-def validate_uploaded_file(file: UploadFile) -> None:
-    """Validate uploaded file"""
+def validate_uploaded_file(file: UploadFile) -> Optional[int]:
+    """Validate uploaded file and return its size in bytes (if known)"""
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file provided")
     
     # Check file size (10MB limit)
     max_size = 10 * 1024 * 1024  # 10MB
+    size = None
     if hasattr(file.file, 'seek') and hasattr(file.file, 'tell'):
         file.file.seek(0, 2)  # Seek to end
         size = file.file.tell()
@@ -104,6 +128,8 @@ def validate_uploaded_file(file: UploadFile) -> None:
             status_code=400, 
             detail=f"Unsupported file type. Allowed types: {allowed_types}"
         )
+    
+    return size
 
 # Main API endpoint - Extract amounts from medical documents
 @app.post("/extract-amounts", response_model=ResponseModel)
@@ -133,7 +159,7 @@ async def extract_amounts(
     
     try:
         logger.info("Processing extract-amounts request")
-        processing_start_time = datetime.now()
+        processing_start_time = time.monotonic()
         
         # === Input Validation ===
         if not file and not text:
@@ -147,21 +173,18 @@ async def extract_amounts(
         
         if file:
             # Validate uploaded file
-            validate_uploaded_file(file)
-            
-            # Read file data
-            file_data = await file.read()
-            logger.info(f"Processing uploaded file: {file.filename} ({len(file_data)} bytes)")
+            file_size = validate_uploaded_file(file)
+            logger.info(f"Processing uploaded file: {file.filename} ({file_size} bytes)")
             
-            # Process with OCR
-            ocr_result = ocr_service.process_input(image_data=file_data)
+            # Process with OCR straight from the spooled upload (no in-memory copy)
+            ocr_result = await asyncio.to_thread(ocr_service.process_input, image_stream=file.file)
         
         else:
             # Process direct text input
             text = utility_service.sanitize_text_input(text)
             logger.info(f"Processing direct text input ({len(text)} characters)")
             
-            ocr_result = ocr_service.process_input(text=text)
+            ocr_result = await asyncio.to_thread(ocr_service.process_input, text=text)
         
         logger.info(f"Step 1 completed: {len(ocr_result.raw_tokens)} tokens extracted, confidence: {ocr_result.confidence}")
         
@@ -182,7 +205,9 @@ async def extract_amounts(
         # === Step 2: Normalization ===
         logger.info("Step 2: Starting Normalization")
         
-        normalization_result = normalization_service.process_tokens(ocr_result.raw_tokens)
+        normalization_result = await asyncio.to_thread(
+            normalization_service.process_tokens, ocr_result.raw_tokens
+        )
         
         logger.info(f"Step 2 completed: {len(normalization_result.normalized_amounts)} amounts normalized, confidence: {normalization_result.normalization_confidence}")
         
@@ -196,14 +221,10 @@ async def extract_amounts(
         # === Step 3: Classification by Context ===
         logger.info("Step 3: Starting Classification")
         
-        # Get original text for context
-        if file:
-            # Re-extract text for classification context (could be optimized)
-            original_text, _ = ocr_service.extract_text_from_image(file_data)
-        else:
-            original_text = text
+        # Reuse the text extracted in Step 1 for context (no second OCR pass)
+        original_text = ocr_result.raw_text
         
-        classification_result = classification_svc.process_amounts(
+        classification_result = await classification_svc.process_amounts_async(
             original_text, 
             normalization_result.normalized_amounts
         )
@@ -220,7 +241,7 @@ async def extract_amounts(
         )
         
         # Log processing time
-        processing_time = (datetime.now() - processing_start_time).total_seconds()
+        processing_time = time.monotonic() - processing_start_time
         logger.info(f"Step 4 completed: Final output generated in {processing_time:.2f}s")
         
         # === Success Response ===
@@ -303,10 +324,9 @@ async def debug_step1_ocr(
     """Debug endpoint to test Step 1 (OCR) only"""
     try:
         if file:
-            file_data = await file.read()
-            return ocr_service.process_input(image_data=file_data)
+            return await asyncio.to_thread(ocr_service.process_input, image_stream=file.file)
         elif text:
-            return ocr_service.process_input(text=text)
+            return await asyncio.to_thread(ocr_service.process_input, text=text)
         else:
             raise HTTPException(status_code=400, detail="Provide file or text")
     except Exception as e:
@@ -327,7 +347,7 @@ async def debug_step3_classification(
 ):
     """Debug endpoint to test Step 3 (Classification) only"""
     try:
-        return classification_svc.process_amounts(request.text, request.amounts)
+        return await classification_svc.process_amounts_async(request.text, request.amounts)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -351,19 +371,26 @@ async def http_exception_handler(request, exc):
     )
 
 # Custom middleware for request logging
+# Health/info probes are polled frequently and are not worth a log line
+UNLOGGED_PATHS = frozenset({"/health", "/"})
+
 @app.middleware("http")
 async def log_requests(request, call_next):
     """Log all incoming requests"""
-    start_time = datetime.now()
+    path = request.url.path
+    if path in UNLOGGED_PATHS or not logger.isEnabledFor(logging.INFO):
+        return await call_next(request)
+    
+    start_time = time.monotonic()
     
     # Log request
-    logger.info(f"Request: {request.method} {request.url.path}")
+    logger.info(f"Request: {request.method} {path}")
     
     # Process request
     response = await call_next(request)
     
     # Log response
-    process_time = (datetime.now() - start_time).total_seconds()
+    process_time = time.monotonic() - start_time
     logger.info(f"Response: {response.status_code} - {process_time:.2f}s")
     
     return response
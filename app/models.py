@@ -3,23 +3,31 @@
 Pydantic models for request/response validation
 Following the exact JSON schemas from problem statement
 """
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import List, Dict, Optional, Union
 
+# Allowed values for the final output validators
+_VALID_TYPES = frozenset({
+    'total_bill', 'paid', 'due', 'discount', 'tax',
+    'consultation', 'medicine', 'test', 'other'
+})
+_VALID_CURRENCIES = frozenset({'INR', 'USD', 'EUR'})
+_VALID_STATUSES = frozenset({'ok', 'no_amounts_found', 'low_confidence', 'normalization_failed', 'error'})
+
 class OCROutput(BaseModel):
     """Output from Step 1 - OCR/Text Extraction"""
     raw_tokens: List[str] = Field(..., description="Raw numeric tokens extracted")
     currency_hint: str = Field(..., description="Detected currency hint")
     confidence: float = Field(..., ge=0.0, le=1.0, description="OCR confidence score")
+    raw_text: str = Field("", exclude=True, description="Full extracted text (internal, reused for classification)")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "raw_tokens": ["1200", "1000", "200", "10%"],
-                "currency_hint": "INR",
-                "confidence": 0.74
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "raw_tokens": ["1200", "1000", "200", "10%"],
+            "currency_hint": "INR",
+            "confidence": 0.74
         }
+    })
 
 # Step 2: Normalization Models
 class NormalizationOutput(BaseModel):
@@ -27,13 +35,12 @@ class NormalizationOutput(BaseModel):
     normalized_amounts: List[float] = Field(..., description="Normalized numeric amounts")
     normalization_confidence: float = Field(..., ge=0.0, le=1.0, description="Normalization confidence")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "normalized_amounts": [1200, 1000, 200],
-                "normalization_confidence": 0.82
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "normalized_amounts": [1200, 1000, 200],
+            "normalization_confidence": 0.82
         }
+    })
 
 # Step 3: Classification Models
 class ClassifiedAmount(BaseModel):
@@ -42,23 +49,25 @@ class ClassifiedAmount(BaseModel):
     value: float = Field(..., description="Numeric value")
     context: Optional[str] = Field(None, description="Context explanation")
     name: Optional[str] = Field(None, description="Specific name or description of the item/service")
+    # Set during classification when context is already a "text: '...'" source;
+    # internal only, never serialized
+    has_source: bool = Field(False, exclude=True, description="Context is a source text quote")
 
 class ClassificationOutput(BaseModel):
     """Output from Step 3 - Classification by Context"""
     amounts: List[ClassifiedAmount] = Field(..., description="Classified amounts")
     confidence: float = Field(..., ge=0.0, le=1.0, description="Classification confidence")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "amounts": [
-                    {"type": "total_bill", "value": 1200},
-                    {"type": "paid", "value": 1000},
-                    {"type": "due", "value": 200}
-                ],
-                "confidence": 0.80
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "amounts": [
+                {"type": "total_bill", "value": 1200},
+                {"type": "paid", "value": 1000},
+                {"type": "due", "value": 200}
+            ],
+            "confidence": 0.80
         }
+    })
 
 # Step 4: Final Output Models
 class AmountInfo(BaseModel):
@@ -68,15 +77,10 @@ class AmountInfo(BaseModel):
     source: str = Field(..., description="Source text with provenance")
     name: Optional[str] = Field(None, description="Specific name or description of the item/service")
 
-    @validator('type')
+    @field_validator('type')
+    @classmethod
     def validate_type(cls, v):
-        valid_types = [
-            'total_bill', 'paid', 'due', 'discount', 'tax',
-            'consultation', 'medicine', 'test', 'other'
-        ]
-        if v not in valid_types:
-            return 'other'  # Default to 'other' if invalid type
-        return v
+        return v if v in _VALID_TYPES else 'other'  # Default to 'other' if invalid type
 
 class FinalOutput(BaseModel):
     """Final output from Step 4 - Structured JSON with provenance"""
@@ -84,51 +88,48 @@ class FinalOutput(BaseModel):
     amounts: List[AmountInfo] = Field(..., description="Classified amounts with provenance")
     status: str = Field(..., description="Processing status")
 
-    @validator('currency')
+    @field_validator('currency')
+    @classmethod
     def validate_currency(cls, v):
-        if v not in ['INR', 'USD', 'EUR']:
-            return 'INR'  # Default to INR
-        return v
+        return v if v in _VALID_CURRENCIES else 'INR'  # Default to INR
 
-    @validator('status')
+    @field_validator('status')
+    @classmethod
     def validate_status(cls, v):
-        if v not in ['ok', 'no_amounts_found', 'low_confidence', 'normalization_failed', 'error']:
-            return 'ok'
-        return v
-
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "currency": "INR",
-                "amounts": [
-                    {
-                        "type": "total_bill",
-                        "value": 1200,
-                        "source": "text: 'Total: INR 1200'",
-                        "name": "Total Amount"
-                    },
-                    {
-                        "type": "paid",
-                        "value": 1000,
-                        "source": "text: 'Paid: 1000'",
-                        "name": "Advance Payment"
-                    },
-                    {
-                        "type": "due",
-                        "value": 200,
-                        "source": "text: 'Due: 200'",
-                        "name": "Balance Due"
-                    },
-                    {
-                        "type": "medicine",
-                        "value": 150,
-                        "source": "text: 'Paracetamol 200mg: Rs 150'",
-                        "name": "Paracetamol 200mg"
-                    }
-                ],
-                "status": "ok"
-            }
+        return v if v in _VALID_STATUSES else 'ok'
+
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "currency": "INR",
+            "amounts": [
+                {
+                    "type": "total_bill",
+                    "value": 1200,
+                    "source": "text: 'Total: INR 1200'",
+                    "name": "Total Amount"
+                },
+                {
+                    "type": "paid",
+                    "value": 1000,
+                    "source": "text: 'Paid: 1000'",
+                    "name": "Advance Payment"
+                },
+                {
+                    "type": "due",
+                    "value": 200,
+                    "source": "text: 'Due: 200'",
+                    "name": "Balance Due"
+                },
+                {
+                    "type": "medicine",
+                    "value": 150,
+                    "source": "text: 'Paracetamol 200mg: Rs 150'",
+                    "name": "Paracetamol 200mg"
+                }
+            ],
+            "status": "ok"
         }
+    })
 
 # Guardrail/Error Response Models
 class ErrorResponse(BaseModel):
@@ -136,49 +137,45 @@ class ErrorResponse(BaseModel):
     status: str = Field(..., description="Error status")
     reason: str = Field(..., description="Error reason/description")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "status": "no_amounts_found",
-                "reason": "document too noisy"
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "status": "no_amounts_found",
+            "reason": "document too noisy"
         }
+    })
 
 # Request Models
 class TextRequest(BaseModel):
     """Request model for text input"""
     text: str = Field(..., min_length=1, description="Input text to process")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "text": "Total: INR 1200 | Paid: 1000 | Due: 200 | Discount: 10%"
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "text": "Total: INR 1200 | Paid: 1000 | Due: 200 | Discount: 10%"
         }
+    })
 
 class ClassificationRequest(BaseModel):
     """Request model for classification debug endpoint"""
     text: str = Field(..., min_length=1, description="Input text to classify")
     amounts: List[float] = Field(..., description="List of amounts to classify")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "text": "Total: INR 1200 | Paid: 1000 | Due: 200",
-                "amounts": [1200, 1000, 200]
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "text": "Total: INR 1200 | Paid: 1000 | Due: 200",
+            "amounts": [1200, 1000, 200]
         }
+    })
 
 class NormalizationRequest(BaseModel):
     """Request model for normalization debug endpoint"""
     tokens: List[str] = Field(..., description="List of tokens to normalize")
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "tokens": ["1200", "1000", "200", "10%"]
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "tokens": ["1200", "1000", "200", "10%"]
         }
+    })
 
 # Response Models Union
 ResponseModel = Union[FinalOutput, ErrorResponse]
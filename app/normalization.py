@@ -5,57 +5,76 @@ Fix OCR digit errors and map to numbers with high accuracy
 """
 import re
 import logging
+from array import array
+import numpy as np
 from typing import List, Dict, Tuple, Optional
 from .models import NormalizationOutput
 
 logger = logging.getLogger(__name__)
 
+# Precompiled pattern for leading currency symbols
+_PAT_CURRENCY_SYMBOLS = re.compile(r'^[₹$€£]+')
+
+def _is_plain_number(token: str) -> bool:
+    """Digits with at most one decimal point, which must be followed by a digit"""
+    integer_part, dot, fraction = token.partition('.')
+    if dot:
+        return fraction.isdecimal() and (not integer_part or integer_part.isdecimal())
+    return integer_part.isdecimal()
+
 class NormalizationService:
     """Service to normalize and clean OCR-extracted numeric tokens"""
     
-    def __init__(self):
-        """Initialize normalization service with error correction mappings"""
-        
-        # Common OCR digit errors and their corrections
-        self.ocr_digit_corrections = {
-            'O': '0',  # Letter O to zero
-            'o': '0',  # Lowercase o to zero
-            'I': '1',  # Letter I to one
-            'l': '1',  # Lowercase L to one
-            '|': '1',  # Pipe to one
-            'S': '5',  # Letter S to five
-            's': '5',  # Lowercase s to five
-            'G': '6',  # Letter G to six
-            'B': '8',  # Letter B to eight
-            'g': '9',  # Lowercase g to nine
-            'Z': '2',  # Letter Z to two
-        }
-        
-        # Character patterns that should be removed/replaced
-        self.cleanup_patterns = [
-            (r'[,\s]+', ''),  # Remove commas and spaces within numbers
-            (r'\.{2,}', '.'),  # Multiple dots to single dot
-            (r'^\.+|\.+$', ''),  # Leading/trailing dots
-        ]
-        
-        # Validation ranges for different amount types
-        self.amount_ranges = {
-            'consultation': (50, 5000),
-            'medicine': (10, 10000),
-            'test': (100, 15000),
-            'total_bill': (100, 100000),
-            'general': (0.01, 100000)
-        }
+    # Configuration is shared, read-only class state; the singleton carries no
+    # per-instance dict
+    __slots__ = ()
+    
+    # Common OCR digit errors and their corrections
+    ocr_digit_corrections = {
+        'O': '0',  # Letter O to zero
+        'o': '0',  # Lowercase o to zero
+        'I': '1',  # Letter I to one
+        'l': '1',  # Lowercase L to one
+        '|': '1',  # Pipe to one
+        'S': '5',  # Letter S to five
+        's': '5',  # Lowercase s to five
+        'G': '6',  # Letter G to six
+        'B': '8',  # Letter B to eight
+        'g': '9',  # Lowercase g to nine
+        'Z': '2',  # Letter Z to two
+    }
+    
+    # Translation table so corrections run as a single pass over the token
+    _ocr_trans = str.maketrans(ocr_digit_corrections)
+    
+    # Character patterns that should be removed/replaced
+    cleanup_patterns = (
+        (r'[,\s]+', ''),  # Remove commas and spaces within numbers
+        (r'\.{2,}', '.'),  # Multiple dots to single dot
+        (r'^\.+|\.+$', ''),  # Leading/trailing dots
+    )
+    _cleanup_patterns = tuple(
+        (re.compile(pattern), replacement) for pattern, replacement in cleanup_patterns
+    )
+    
+    # Validation ranges for different amount types
+    amount_ranges = {
+        'consultation': (50, 5000),
+        'medicine': (10, 10000),
+        'test': (100, 15000),
+        'total_bill': (100, 100000),
+        'general': (0.01, 100000)
+    }
+    
+    # General bounds, unpacked once for the per-token range check
+    _general_min, _general_max = amount_ranges['general']
+    
+    # Token count from which conversion and validation run vectorized
+    vectorize_min_tokens = 8
 
     def apply_ocr_corrections(self, token: str) -> str:
         """Apply OCR digit error corrections"""
-        corrected = token
-        
-        # Apply character-by-character corrections
-        for wrong_char, correct_char in self.ocr_digit_corrections.items():
-            corrected = corrected.replace(wrong_char, correct_char)
-        
-        return corrected
+        return token.translate(self._ocr_trans)
 
     def clean_token(self, token: str) -> str:
         """Clean and standardize a numeric token"""
@@ -66,8 +85,8 @@ class NormalizationService:
         cleaned = self.apply_ocr_corrections(token)
         
         # Apply cleanup patterns
-        for pattern, replacement in self.cleanup_patterns:
-            cleaned = re.sub(pattern, replacement, cleaned)
+        for pattern, replacement in self._cleanup_patterns:
+            cleaned = pattern.sub(replacement, cleaned)
         
         # Handle special cases
         cleaned = self._handle_special_cases(cleaned)
@@ -94,7 +113,7 @@ class NormalizationService:
             token = token[:-1]
         
         # Handle currency symbols at the beginning
-        token = re.sub(r'^[₹$€£]+', '', token)
+        token = _PAT_CURRENCY_SYMBOLS.sub('', token)
         
         # Ensure only one decimal point
         decimal_count = token.count('.')
@@ -119,7 +138,7 @@ class NormalizationService:
         
         try:
             # Handle empty or invalid tokens
-            if not re.match(r'^\d*\.?\d+$', token):
+            if not _is_plain_number(token):
                 return None
             
             # Convert to float
@@ -135,6 +154,26 @@ class NormalizationService:
         except (ValueError, TypeError):
             return None
 
+    def _normalize_vectorized(self, raw_tokens: List[str]) -> List[float]:
+        """Clean tokens, then convert, validate and dedupe them as one array"""
+        
+        # Cleaning stays per token; only tokens convert_to_number would accept are parsed.
+        # Rounding uses the builtin: np.round scales by 100 first and can differ in the
+        # last cent for tokens with more than 2 decimals.
+        cleaned_tokens = (self.clean_token(token) for token in raw_tokens)
+        amounts = np.fromiter(
+            (round(float(cleaned), 2) for cleaned in cleaned_tokens
+             if _is_plain_number(cleaned)),
+            dtype=np.float64
+        )
+        
+        # Keep the general validation range
+        amounts = amounts[(amounts >= self._general_min) & (amounts <= self._general_max)]
+        
+        # Remove duplicates while preserving order (first occurrence wins)
+        _, first_index = np.unique(amounts, return_index=True)
+        return amounts[np.sort(first_index)].tolist()
+
     def calculate_normalization_confidence(self, 
                                          original_tokens: List[str], 
                                          normalized_amounts: List[float]) -> float:
@@ -143,26 +182,30 @@ class NormalizationService:
         if not original_tokens:
             return 0.0
         
+        # One array view of the amounts for the count and mean below
+        amounts = np.asarray(normalized_amounts, dtype=np.float64)
+        amount_count = amounts.size
+        
         # Base confidence from success rate
-        success_rate = len(normalized_amounts) / len(original_tokens)
+        success_rate = amount_count / len(original_tokens)
         confidence = success_rate * 0.7
         
-        # Boost confidence for reasonable amounts
-        reasonable_count = sum(1 for amount in normalized_amounts 
-                             if self.validate_amount(amount))
-        if normalized_amounts:
-            reasonable_ratio = reasonable_count / len(normalized_amounts)
+        # Boost confidence for reasonable amounts (process_tokens only passes
+        # amounts that already passed the general range check)
+        reasonable_count = amount_count
+        if amount_count:
+            reasonable_ratio = reasonable_count / amount_count
             confidence += reasonable_ratio * 0.2
         
         # Penalty for too many or too few amounts
-        if len(normalized_amounts) > 10:  # Too many amounts detected
+        if amount_count > 10:  # Too many amounts detected
             confidence *= 0.8
-        elif len(normalized_amounts) == 0:  # No amounts detected
+        elif amount_count == 0:  # No amounts detected
             confidence = 0.0
         
         # Boost confidence if amounts are in expected ranges
-        if normalized_amounts:
-            avg_amount = sum(normalized_amounts) / len(normalized_amounts)
+        if amount_count:
+            avg_amount = float(amounts.mean())
             if 100 <= avg_amount <= 5000:  # Typical medical bill range
                 confidence += 0.1
         
@@ -181,35 +224,36 @@ class NormalizationService:
         try:
             logger.info(f"Starting normalization of {len(raw_tokens)} tokens")
             
-            normalized_amounts = []
             processing_log = []
             
-            for i, token in enumerate(raw_tokens):
-                original_token = token
+            if len(raw_tokens) >= self.vectorize_min_tokens:
+                # Large inputs: convert, round, validate and dedupe in NumPy
+                unique_amounts = self._normalize_vectorized(raw_tokens)
+            else:
+                # Unboxed float buffer; converted to a list once at the end
+                normalized_amounts = array('d')
                 
-                # Step 1: Clean the token
-                cleaned_token = self.clean_token(token)
-                
-                # Step 2: Convert to number
-                amount = self.convert_to_number(cleaned_token)
-                
-                if amount is not None:
-                    # Step 3: Validate the amount
-                    if self.validate_amount(amount):
-                        normalized_amounts.append(amount)
-                        processing_log.append(f"Token '{original_token}' -> {amount}")
+                for i, token in enumerate(raw_tokens):
+                    original_token = token
+                    
+                    # Step 1: Clean the token
+                    cleaned_token = self.clean_token(token)
+                    
+                    # Step 2: Convert to number
+                    amount = self.convert_to_number(cleaned_token)
+                    
+                    if amount is not None:
+                        # Step 3: Validate the amount
+                        if self._general_min <= amount <= self._general_max:
+                            normalized_amounts.append(amount)
+                            processing_log.append(f"Token '{original_token}' -> {amount}")
+                        else:
+                            processing_log.append(f"Token '{original_token}' -> {amount} (rejected: out of range)")
                     else:
-                        processing_log.append(f"Token '{original_token}' -> {amount} (rejected: out of range)")
-                else:
-                    processing_log.append(f"Token '{original_token}' -> None (conversion failed)")
-            
-            # Remove duplicates while preserving order
-            seen = set()
-            unique_amounts = []
-            for amount in normalized_amounts:
-                if amount not in seen:
-                    unique_amounts.append(amount)
-                    seen.add(amount)
+                        processing_log.append(f"Token '{original_token}' -> None (conversion failed)")
+                
+                # Remove duplicates while preserving order
+                unique_amounts = list(dict.fromkeys(normalized_amounts.tolist()))
             
             # Calculate confidence
             confidence = self.calculate_normalization_confidence(raw_tokens, unique_amounts)
@@ -219,8 +263,9 @@ class NormalizationService:
             for log_entry in processing_log:
                 logger.debug(log_entry)
             
-            # Create output following exact schema
-            result = NormalizationOutput(
+            # Create output following exact schema. Validation is skipped: amounts are
+            # floats already bounded by validate_amount and confidence is clamped to [0, 1]
+            result = NormalizationOutput.model_construct(
                 normalized_amounts=unique_amounts,
                 normalization_confidence=round(confidence, 2)
             )
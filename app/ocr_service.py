@@ -3,51 +3,130 @@
 Step 1: OCR/Text Extraction Service
 Simple, reliable approach focused on extracting amounts correctly
 """
-import pytesseract
-from PIL import Image, ImageEnhance, ImageFilter
-import cv2
 import numpy as np
 import re
 import io
 import logging
-from typing import List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import BinaryIO, Iterator, List, Tuple, Optional, Union
 from .models import OCROutput
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Single scan for every amount shape. Each alternative sits inside a lookahead so
+# it is tried at every position, and the digits are captured in a named group:
+#   comma - amounts with commas and decimals (4,000.00, 2,765.54, 15,143.54)
+#   round - round amounts (5000; years and IDs are filtered afterwards)
+#   curr  - currency prefixed amounts (Rs.5000, ₹1000)
+#   ctx   - contextual amounts (Amount: 15143.54)
+_PAT_AMOUNTS = re.compile(
+    r'(?=(?P<comma>(?<!-)\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\b)'
+    r'|\b(?P<round>\d{4,5})(?!\d)\b'
+    r'|(?:Rs\.?|₹)\s*(?P<curr>\d{3,6})'
+    r'|(?:Amount|Total|Bill|Paid|Due)\s*:?\s*(?P<ctx>\d{1,6}(?:\.\d{2})?))',
+    re.IGNORECASE
+)
+_AMOUNT_KINDS = ('comma', 'round', 'curr', 'ctx')
+
+def _iter_candidates(text: str) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (kind, token) amount candidates from a single scan of text
+    
+    A kind only matches again after its previous match ends, which keeps each
+    kind's matches non-overlapping.
+    """
+    last_end = dict.fromkeys(_AMOUNT_KINDS, 0)
+    
+    for m in _PAT_AMOUNTS.finditer(text):
+        kind = m.lastgroup
+        if m.start() < last_end[kind]:
+            continue
+        last_end[kind] = m.end(kind)
+        token = m.group(kind)
+        
+        # Filter out years and obvious IDs
+        if kind == 'round' and (2020 <= int(token) <= 2030 or int(token) < 1000):
+            continue
+        yield kind, token
+
+# Currency markers, one named group per currency code. Detection priority is
+# INR, then USD, then EUR, regardless of where in the text each marker appears.
+_CURRENCY_RE = re.compile(
+    r'(?P<INR>\b(?:rs|inr)(?![a-z])|₹|rupee|paisa)'
+    r'|(?P<USD>\$|\busd\b|dollar)'
+    r'|(?P<EUR>€|\beur\b|euro)',
+    re.IGNORECASE
+)
+_CURRENCY_PRIORITY = ('INR', 'USD', 'EUR')
+
+# Shared pool for the OCR config passes; Tesseract runs as a subprocess, so the
+# passes overlap without contending on the GIL
+_OCR_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix="ocr")
+
+# Medical keywords for the extraction confidence boost. Substring matches,
+# found in one case-insensitive scan; the lookahead lets hits overlap
+_MED_RE = re.compile(r'(?=(bill|amount|total|room|pharmacy|hospital))', re.IGNORECASE)
+
+# OCR score (avg confidence + 10 per long number) that is good enough to skip
+# the remaining configs: ~85% confidence with at least 3 amounts
+_EARLY_EXIT_SCORE = 85 + 3 * 10
+
+@lru_cache(maxsize=None)
+def _ocr_backends():
+    """Import the imaging/OCR libraries on first use; text-only requests never load them"""
+    import cv2
+    import pytesseract
+    from PIL import Image
+    return cv2, pytesseract, Image
+
+_PAT_NON_NUMERIC = re.compile(r'[^\d.,]')
+_PAT_LONG_NUMBER = re.compile(r'\d{3,}')
+
 class OCRService:
     """Simple, reliable OCR service for medical documents"""
     
-    def __init__(self):
-        """Initialize OCR service with simple configuration"""
-        # Currency patterns for detection
-        self.currency_patterns = {
-            'INR': [r'(?:Rs\.?|INR|₹)', r'rupees?', r'paisa'],
-            'USD': [r'\$', r'USD', r'dollars?'],
-            'EUR': [r'€', r'EUR', r'euros?']
-        }
-
-    def extract_text_from_image(self, image_data: bytes) -> Tuple[str, float]:
-        """Simple, reliable text extraction"""
+    # Stateless: patterns and pools live at module level
+    __slots__ = ()
+    
+    def extract_text_from_image(self, image_data: Union[bytes, BinaryIO]) -> Tuple[str, float]:
+        """Simple, reliable text extraction from image bytes or a binary file object"""
         try:
-            # Open image with PIL
-            image = Image.open(io.BytesIO(image_data))
+            cv2, pytesseract, Image = _ocr_backends()
             
-            # Convert to RGB
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # Open image with PIL (file objects are decoded in place, without a copy)
+            if isinstance(image_data, (bytes, bytearray)):
+                image_data = io.BytesIO(image_data)
+            image = Image.open(image_data)
             
-            # Simple resize if image is too small
+            # Let libjpeg decode large scans straight to grayscale at a reduced
+            # scale (never below 1500px per side)
+            if image.format == 'JPEG':
+                image.draft('L', (1500, 1500))
+            
+            # Convert to grayscale once; Tesseract works on a single channel anyway
+            if image.mode != 'L':
+                image = image.convert('L')
+            
+            # Simple resize if image is too small; bilinear is plenty for OCR
             width, height = image.size
-            if width < 1500 or height < 1500:
+            if min(width, height) < 1200:
                 scale = max(1500/width, 1500/height)
                 new_width = int(width * scale)
                 new_height = int(height * scale)
-                image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                image = image.resize((new_width, new_height), Image.Resampling.BILINEAR)
+            
+            # Binarize once with a local (adaptive) threshold; evens out shadows and
+            # uneven lighting on scanned bills, and is reused by every OCR config
+            pixels = cv2.adaptiveThreshold(
+                np.asarray(image), 255,
+                cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10
+            )
             
-            # Try multiple simple OCR approaches
+            # Try multiple simple OCR approaches. The uniform block pass runs
+            # first; the others only run (concurrently) if it is not good enough
             ocr_configs = [
                 '--oem 3 --psm 6',  # Uniform block
                 '--oem 3 --psm 4',  # Single column
@@ -57,31 +136,39 @@ class OCRService:
             best_text = ""
             best_confidence = 0
             
-            for config in ocr_configs:
-                try:
-                    # Extract text
-                    text = pytesseract.image_to_string(image, config=config)
-                    
-                    # Get confidence data
-                    data = pytesseract.image_to_data(
-                        image, config=config, output_type=pytesseract.Output.DICT
+            for stage in (ocr_configs[:1], ocr_configs[1:]):
+                if best_confidence >= _EARLY_EXIT_SCORE:
+                    break
+                
+                # One Tesseract run per config gives both the words and their confidences
+                futures = [
+                    _OCR_POOL.submit(
+                        pytesseract.image_to_data,
+                        pixels, config=config, output_type=pytesseract.Output.DICT
                     )
-                    
-                    # Calculate confidence
-                    confidences = [int(c) for c in data['conf'] if int(c) > 0]
-                    avg_conf = sum(confidences) / len(confidences) if confidences else 0
-                    
-                    # Score based on amount detection
-                    amount_count = len(re.findall(r'\d{3,}', text))
-                    score = avg_conf + (amount_count * 10)
-                    
-                    if score > best_confidence:
-                        best_confidence = score
-                        best_text = text
+                    for config in stage
+                ]
+                
+                for future in futures:
+                    try:
+                        data = future.result()
+                        text = self._text_from_ocr_data(data)
                         
-                except Exception as e:
-                    logger.warning(f"OCR config failed: {e}")
-                    continue
+                        # Calculate confidence
+                        confidences = [int(c) for c in data['conf'] if int(c) > 0]
+                        avg_conf = sum(confidences) / len(confidences) if confidences else 0
+                        
+                        # Score based on amount detection
+                        amount_count = len(_PAT_LONG_NUMBER.findall(text))
+                        score = avg_conf + (amount_count * 10)
+                        
+                        if score > best_confidence:
+                            best_confidence = score
+                            best_text = text
+                            
+                    except Exception as e:
+                        logger.warning(f"OCR config failed: {e}")
+                        continue
             
             # Normalize confidence
             final_confidence = min(best_confidence / 100.0, 1.0)
@@ -96,49 +183,33 @@ class OCRService:
             raise ValueError(f"OCR processing failed: {e}")
     
 
+    def _text_from_ocr_data(self, data: dict) -> str:
+        """Rebuild plain text from image_to_data output, one line per Tesseract line"""
+        lines = {}
+        for word, block, par, line in zip(data['text'], data['block_num'],
+                                          data['par_num'], data['line_num']):
+            if word and word.strip():
+                lines.setdefault((block, par, line), []).append(word)
+        
+        return '\n'.join(' '.join(words) for words in lines.values())
+
     def extract_numeric_tokens(self, text: str) -> List[str]:
         """Extract amounts using comprehensive patterns"""
         
         logger.info(f"Extracting from text: {text}")
         
-        all_tokens = []
-        
-        # Pattern 1: Amounts with commas and decimals (4,000.00, 2,765.54, 15,143.54)
-        pattern1 = r'(?<!-)\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\b'
-        matches1 = re.findall(pattern1, text)
-        all_tokens.extend(matches1)
-        logger.info(f"Pattern 1 (x,xxx.xx): {matches1}")
-        
-        
-        # Pattern 3: Round amounts (5000, but exclude years and IDs)
-        pattern3 = r'\b(\d{4,5})(?!\d)\b'
-        matches3 = re.findall(pattern3, text)
-        # Filter out years and obvious IDs
-        filtered3 = [m for m in matches3 if not (2020 <= int(m) <= 2030) and int(m) >= 1000]
-        all_tokens.extend(filtered3)
-        logger.info(f"Pattern 3 (round amounts): {filtered3}")
-        
-        # Pattern 4: Currency prefixed amounts (Rs.5000, ₹1000)
-        pattern4 = r'(?:Rs\.?|₹)\s*(\d{3,6})'
-        matches4 = re.findall(pattern4, text, re.IGNORECASE)
-        all_tokens.extend(matches4)
-        logger.info(f"Pattern 4 (currency prefix): {matches4}")
-        
-        # Pattern 5: Contextual amounts (Amount: 15143.54)
-        pattern5 = r'(?:Amount|Total|Bill|Paid|Due)\s*:?\s*(\d{1,6}(?:\.\d{2})?)'
-        matches5 = re.findall(pattern5, text, re.IGNORECASE)
-        all_tokens.extend(matches5)
-        logger.info(f"Pattern 5 (contextual): {matches5}")
-        
-        # Clean and validate all tokens
-        valid_tokens = []
-        seen = set()
-        
-        for token in all_tokens:
+        # Clean and validate candidates as they stream out of the scan, deduping
+        # per kind. Buckets are merged in comma, round, currency, contextual
+        # order, so the first occurrence in that order wins.
+        buckets = {kind: {} for kind in _AMOUNT_KINDS}
+        for kind, token in _iter_candidates(text):
             cleaned = self._clean_token(token)
-            if cleaned and cleaned not in seen and self._is_valid_amount(cleaned):
-                valid_tokens.append(cleaned)
-                seen.add(cleaned)
+            if cleaned and cleaned not in buckets[kind] and self._is_valid_amount(cleaned):
+                buckets[kind][cleaned] = None
+        
+        valid_tokens = list(dict.fromkeys(
+            token for kind in _AMOUNT_KINDS for token in buckets[kind]
+        ))
         
         logger.info(f"Final valid tokens: {valid_tokens}")
         return valid_tokens
@@ -149,7 +220,7 @@ class OCRService:
             return None
         
         # Remove any non-numeric characters except comma and dot
-        cleaned = re.sub(r'[^\d.,]', '', token.strip())
+        cleaned = _PAT_NON_NUMERIC.sub('', token.strip())
         
         # Remove leading/trailing punctuation
         cleaned = cleaned.strip('.,')
@@ -175,12 +246,15 @@ class OCRService:
 
     def detect_currency(self, text: str) -> str:
         """Detect currency from text"""
-        text_lower = text.lower()
+        found = set()
+        for m in _CURRENCY_RE.finditer(text):
+            found.add(m.lastgroup)
+            if m.lastgroup == _CURRENCY_PRIORITY[0]:
+                break
         
-        for currency, patterns in self.currency_patterns.items():
-            for pattern in patterns:
-                if re.search(pattern, text_lower):
-                    return currency
+        for currency in _CURRENCY_PRIORITY:
+            if currency in found:
+                return currency
         
         return "INR"
 
@@ -195,23 +269,25 @@ class OCRService:
         # Boost for number of tokens found
         confidence += min(len(tokens) * 0.1, 0.3)
         
-        # Boost for medical keywords
-        medical_words = ['bill', 'amount', 'total', 'room', 'pharmacy', 'hospital']
-        keyword_count = sum(1 for word in medical_words if word in text.lower())
+        # Boost for medical keywords (each distinct keyword counts once)
+        keyword_count = len({word.lower() for word in _MED_RE.findall(text)})
         confidence += min(keyword_count * 0.02, 0.1)
         
         return min(confidence, 1.0)
 
-    def process_input(self, image_data: bytes = None, text: str = None) -> OCROutput:
+    def process_input(self, image_data: bytes = None, text: str = None,
+                      image_stream: BinaryIO = None) -> OCROutput:
         """Main processing method"""
         try:
             if image_data:
                 extracted_text, ocr_confidence = self.extract_text_from_image(image_data)
+            elif image_stream is not None:
+                extracted_text, ocr_confidence = self.extract_text_from_image(image_stream)
             elif text:
                 extracted_text = text
                 ocr_confidence = 1.0
             else:
-                raise ValueError("Either image_data or text must be provided")
+                raise ValueError("Either image_data, image_stream or text must be provided")
             
             # Extract tokens
             tokens = self.extract_numeric_tokens(extracted_text)
@@ -224,10 +300,13 @@ class OCRService:
                 extracted_text, tokens, ocr_confidence
             )
             
-            result = OCROutput(
+            # Built from trusted values (tokens are str, confidence clamped to [0, 1]),
+            # so skip pydantic validation
+            result = OCROutput.model_construct(
                 raw_tokens=tokens,
                 currency_hint=currency_hint,
-                confidence=round(final_confidence, 2)
+                confidence=round(final_confidence, 2),
+                raw_text=extracted_text
             )
             
             logger.info(f"OCR completed: {len(tokens)} tokens, confidence: {final_confidence:.2f}")
@@ -3,37 +3,33 @@
 Prompt templates for AI services
 Centralized prompt management for the Medical Amount Detection API
 """
+from functools import lru_cache
 
-def get_classification_prompt(text: str) -> str:
-    """
-    Generate the classification prompt for Gemini AI
-    
-    Args:
-        text: The input text to classify
-        
-    Returns:
-        Formatted prompt string for Gemini
-    """
-    
-    prompt = f"""You are an AI assistant specialized in analyzing medical bills and receipts. Your task is to classify financial amounts based on their context.
+# Bump whenever a prompt changes so cached classifications are invalidated
+PROMPT_VERSION = "v1"
+
+# Static parts of the classification prompt; the input text goes between them
+_PROMPT_HEAD = """You are an AI assistant specialized in analyzing medical bills and receipts. Your task is to classify financial amounts based on their context.
 
 Input (text):
-{text}
+"""
+
+_PROMPT_TAIL = """
 
 Step 3 - Classification by Context
 Use surrounding text to label amounts and identify specific items/services.
 
 Expected Output (JSON):
-{{
+{
  "amounts": [
-  {{"type":"total_bill","value":1200,"name":"Total Amount","source":"text: 'Total: INR 1200'"}},
-  {{"type":"paid","value":1000,"name":"Advance Payment","source":"text: 'Paid: 1000'"}},
-  {{"type":"due","value":200,"name":"Balance Due","source":"text: 'Due: 200'"}},
-  {{"type":"medicine","value":150,"name":"Paracetamol 200mg","source":"text: 'Paracetamol 200mg: Rs 150'"}},
-  {{"type":"consultation","value":500,"name":"Doctor Consultation","source":"text: 'Doctor Fee: Rs 500'"}}
+  {"type":"total_bill","value":1200,"name":"Total Amount","source":"text: 'Total: INR 1200'"},
+  {"type":"paid","value":1000,"name":"Advance Payment","source":"text: 'Paid: 1000'"},
+  {"type":"due","value":200,"name":"Balance Due","source":"text: 'Due: 200'"},
+  {"type":"medicine","value":150,"name":"Paracetamol 200mg","source":"text: 'Paracetamol 200mg: Rs 150'"},
+  {"type":"consultation","value":500,"name":"Doctor Consultation","source":"text: 'Doctor Fee: Rs 500'"}
  ],
  "confidence": 0.80
-}}
+}
 
 CRITICAL: The "source" field must contain the CORRECTED text, not the original OCR text with errors.
 Example: If OCR shows "Cone uttation: Rs 200", the source should be "text: 'Consultation: Rs 200'" (corrected), NOT "text: 'Cone uttation: Rs 200'" (original with errors).
@@ -49,5 +45,17 @@ INSTRUCTIONS:
 8. Return only the JSON object with amounts array and confidence score
 
 Return only the JSON object, no additional text:"""
+
+@lru_cache(maxsize=256)
+def get_classification_prompt(text: str) -> str:
+    """
+    Generate the classification prompt for Gemini AI
+    Memoized so retries and repeated documents reuse the built prompt
     
-    return prompt
+    Args:
+        text: The input text to classify
+        
+    Returns:
+        Formatted prompt string for Gemini
+    """
+    return _PROMPT_HEAD + text + _PROMPT_TAIL
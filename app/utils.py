@@ -3,107 +3,200 @@
 Utility functions for the Medical Amount Detection API
 """
 import re
+import math
 import logging
-from typing import List, Tuple
-from .models import AmountInfo, FinalOutput, ErrorResponse
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple
+from .models import AmountInfo, FinalOutput, ErrorResponse, _VALID_CURRENCIES, _VALID_STATUSES
 
 logger = logging.getLogger(__name__)
 
-class UtilityService:
-    """Utility functions for final output generation and validation"""
+MAX_CONTEXT_LENGTH = 100  # Maximum characters for source context
+GOOD_CONTEXT_SCORE = 6  # Stop searching once a context scores this high
+
+# Precompiled patterns for input sanitization
+_WS_RE = re.compile(r'\s+')
+_SAFE_RE = re.compile(r'[^\w\s.,;:!?₹$€£\-+=%()/@#&]')
+
+# Same safelist as a str.translate delete table for ASCII characters, derived
+# from _SAFE_RE so the two can never drift apart
+_ASCII_DELETE_TABLE = str.maketrans('', '', ''.join(
+    char for char in map(chr, range(128)) if _SAFE_RE.match(char)
+))
+
+# Allowed output values are defined once in models; these tuples only fix the
+# order used in error messages
+_CURRENCY_CODES = ('INR', 'USD', 'EUR')
+_STATUS_CODES = ('ok', 'no_amounts_found', 'low_confidence', 'normalization_failed', 'error')
+_VALID_ERROR_STATUSES = _VALID_STATUSES - {'ok'}
+
+# Context scoring: keyword/currency weights, looked up per word. Words are runs
+# of letters (so "Rs.1200" still yields "rs"); currency symbols stand alone.
+# The whole keyword set is matched in one C-level regex pass plus dict lookups,
+# so there is no per-keyword scan left for a compiled matcher to replace.
+_SCORE_WEIGHTS = {
+    'total': 2, 'bill': 2, 'paid': 2, 'due': 2, 'balance': 2, 'consultation': 2,
+    'medicine': 2, 'test': 2, 'discount': 2, 'tax': 2, 'amount': 2, 'fee': 2,
+    'rs': 1, 'inr': 1, '₹': 1, '$': 1, 'rupees': 1,
+}
+_SCORE_TOKEN_RE = re.compile(r'[^\W\d_]+|[₹$]')
+
+# Contexts that are only a number (digits with dots/commas)
+_NUMERIC_ONLY_RE = re.compile(r'\s*[.,]*\d[\d.,]*\s*')
+
+def _has_duplicates(values: Iterable) -> bool:
+    """True as soon as any value repeats (single pass, stops at the first repeat)"""
+    seen = set()
+    add = seen.add
+    return any(value in seen or add(value) for value in values)
+
+@lru_cache(maxsize=4)
+def _lower(text: str) -> str:
+    """Lowercased document, computed once for all amounts of the same document"""
+    return text.lower()
+
+def _iter_occurrences(text: str, amount_patterns: Tuple[str, ...]) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (start, end) of case-insensitive, non-overlapping occurrences of each
+    pattern, pattern by pattern and in text order within a pattern
+    """
+    text_lower = _lower(text)
     
-    def __init__(self):
-        """Initialize utility service"""
-        self.max_context_length = 100  # Maximum characters for source context
+    # Fast path: plain substring search on the lowercased text. Only valid when
+    # lowercasing kept every offset in place (a few characters, e.g. 'İ', expand)
+    if len(text_lower) == len(text):
+        for pattern in amount_patterns:
+            pattern_lower = pattern.lower()
+            start_pos = text_lower.find(pattern_lower)
+            while start_pos != -1:
+                end_pos = start_pos + len(pattern_lower)
+                yield start_pos, end_pos
+                start_pos = text_lower.find(pattern_lower, end_pos)
+        return
     
-    def find_source_context(self, original_text: str, amount: float, context_size: int = 50) -> str:
-        """
-        Find the source text context for an amount with provenance
-        
-        Args:
-            original_text: Original document text
-            amount: The amount to find context for
-            context_size: Number of characters before/after the amount
-        
-        Returns:
-            Source context string for provenance
-        """
-        try:
-            # Convert amount to possible string representations
-            amount_patterns = [
-                str(int(amount)),           # 1200
-                str(amount),                # 1200.0
-                f"{amount:.2f}",           # 1200.00
-                f"{amount:.1f}",           # 1200.0
-                f"{int(amount):,}",        # 1,200 (if >= 1000)
-                f"Rs {int(amount)}",       # Rs 1200
-                f"INR {int(amount)}",      # INR 1200
-                f"₹ {int(amount)}",        # ₹ 1200
-                f"Rs.{int(amount)}",       # Rs.1200
-            ]
-            
-            best_context = f"Amount: {amount}"
-            best_score = 0
-            
-            for pattern in amount_patterns:
-                # Find all occurrences of this pattern
-                for match in re.finditer(re.escape(pattern), original_text, re.IGNORECASE):
-                    start_pos = match.start()
-                    end_pos = match.end()
-                    
-                    # Extract surrounding context
-                    context_start = max(0, start_pos - context_size)
-                    context_end = min(len(original_text), end_pos + context_size)
-                    
-                    context = original_text[context_start:context_end].strip()
-                    
-                    # Score this context based on meaningful content
-                    score = self._score_context(context, amount)
-                    
-                    if score > best_score:
-                        best_score = score
-                        best_context = context
-            
-            # Truncate if too long
-            if len(best_context) > self.max_context_length:
-                best_context = best_context[:self.max_context_length] + "..."
-            
-            return best_context
-            
-        except Exception as e:
-            logger.warning(f"Could not find context for amount {amount}: {e}")
-            return f"Amount: {amount}"
+    # Fallback: case-insensitive regex search, one pattern at a time
+    for pattern in amount_patterns:
+        for match in re.finditer(re.escape(pattern), text, re.IGNORECASE):
+            yield match.start(), match.end()
+
+def find_source_context(original_text: str, amount: float, context_size: int = 50) -> str:
+    """
+    Find the source text context for an amount with provenance
     
-    def _score_context(self, context: str, amount: float) -> int:
-        """Score context based on how informative it is"""
-        score = 0
-        context_lower = context.lower()
-        
-        # Boost score for meaningful keywords
-        meaningful_keywords = [
-            'total', 'bill', 'paid', 'due', 'balance', 'consultation',
-            'medicine', 'test', 'discount', 'tax', 'amount', 'fee'
-        ]
-        
-        for keyword in meaningful_keywords:
-            if keyword in context_lower:
-                score += 2
+    Args:
+        original_text: Original document text
+        amount: The amount to find context for
+        context_size: Number of characters before/after the amount
+    
+    Returns:
+        Source context string for provenance
+    
+    Expects a finite amount; empty text and non-finite amounts get the plain
+    fallback context. Anything else that goes wrong propagates to the caller.
+    """
+    if not original_text or not math.isfinite(amount):
+        return f"Amount: {amount}"
+    
+    # Convert amount to possible string representations, currency-prefixed
+    # forms first since they usually sit in the most informative context
+    amount_patterns = [
+        f"Rs {int(amount)}",       # Rs 1200
+        f"INR {int(amount)}",      # INR 1200
+        f"₹ {int(amount)}",        # ₹ 1200
+        f"Rs.{int(amount)}",       # Rs.1200
+        str(int(amount)),           # 1200
+        str(amount),                # 1200.0
+        f"{amount:.2f}",           # 1200.00
+        f"{amount:.1f}",           # 1200.0
+    ]
+    if abs(int(amount)) >= 1000:  # below that it equals str(int(amount))
+        amount_patterns.append(f"{int(amount):,}")  # 1,200
+    
+    # Drop exact duplicates (e.g. str(1200.0) == "1200.0" == f"{1200.0:.1f}")
+    amount_patterns = list(dict.fromkeys(amount_patterns))
+    
+    best_context = f"Amount: {amount}"
+    best_score = 0
+    text_len = len(original_text)
+    
+    # Occurrences come pattern by pattern, so on equal scores the earlier
+    # pattern (then the earlier position) wins
+    for start_pos, end_pos in _iter_occurrences(original_text, tuple(amount_patterns)):
+        # Extract surrounding context
+        context_start = max(0, start_pos - context_size)
+        context_end = min(text_len, end_pos + context_size)
         
-        # Boost score for currency indicators
-        currency_indicators = ['rs', 'inr', '₹', '$', 'rupees']
-        for indicator in currency_indicators:
-            if indicator in context_lower:
-                score += 1
+        context = original_text[context_start:context_end]
         
-        # Boost score for longer, more descriptive context
-        if len(context) > 30:
-            score += 1
+        # Score this context based on meaningful content (surrounding
+        # whitespace is left in; only the winner gets stripped below)
+        score = _score_context(context, amount)
         
-        # Penalty for contexts that are just numbers
-        if context.strip().replace('.', '').replace(',', '').isdigit():
-            score -= 2
+        if score > best_score:
+            best_score = score
+            best_context = context
         
-        return score
+        # Good enough: skip the remaining occurrences and patterns
+        if best_score >= GOOD_CONTEXT_SCORE:
+            break
+    
+    best_context = best_context.strip()
+    
+    # Truncate if too long
+    if len(best_context) > MAX_CONTEXT_LENGTH:
+        best_context = best_context[:MAX_CONTEXT_LENGTH] + "..."
+    
+    return best_context
+
+def _score_context(context: str, amount: float) -> int:
+    """Score context based on how informative it is"""
+    context_lower = context.lower()
+    
+    # Boost score for meaningful keywords (+2) and currency indicators (+1),
+    # each counted once however often it occurs
+    words = set(_SCORE_TOKEN_RE.findall(context_lower))
+    score = sum(_SCORE_WEIGHTS.get(word, 0) for word in words)
+    
+    # Boost score for longer, more descriptive context
+    if len(context) > 30:
+        score += 1
+    
+    # Penalty for contexts that are just numbers
+    if _NUMERIC_ONLY_RE.fullmatch(context):
+        score -= 2
+    
+    return score
+
+def sanitize_text_input(text: str) -> str:
+    """Sanitize and clean text input"""
+    if not text:
+        return ""
+    
+    # Remove excessive whitespace
+    cleaned = _WS_RE.sub(' ', text.strip())
+    
+    # Remove any potential harmful characters (basic sanitization)
+    # Keep alphanumeric, common punctuation, and currency symbols.
+    # ASCII text only needs the translate table; anything else goes through the regex
+    cleaned = cleaned.translate(_ASCII_DELETE_TABLE)
+    if not cleaned.isascii():
+        cleaned = _SAFE_RE.sub('', cleaned)
+    
+    # Limit text length to prevent abuse
+    max_length = 10000  # 10KB limit
+    if len(cleaned) > max_length:
+        cleaned = cleaned[:max_length] + "..."
+        logger.warning("Input text truncated to %d characters", max_length)
+    
+    return cleaned
+
+class UtilityService:
+    """Utility functions for final output generation and validation"""
+    
+    # Thin facade over the module-level functions, kept for API compatibility
+    find_source_context = staticmethod(find_source_context)
+    _score_context = staticmethod(_score_context)
+    sanitize_text_input = staticmethod(sanitize_text_input)
     
     def validate_final_output(self, output: FinalOutput) -> Tuple[bool, List[str]]:
         """
@@ -113,59 +206,61 @@ class UtilityService:
             (is_valid, list_of_errors)
         """
         errors = []
+        append = errors.append
+        extend = errors.extend
         
-        try:
-            # Check required fields
-            if not output.currency:
-                errors.append("Currency field is required")
-            
-            if not isinstance(output.amounts, list):
-                errors.append("Amounts must be a list")
-            
-            if not output.status:
-                errors.append("Status field is required")
-            
-            # Validate currency
-            valid_currencies = ['INR', 'USD', 'EUR']
-            if output.currency not in valid_currencies:
-                errors.append(f"Currency must be one of {valid_currencies}")
-            
-            # Validate status
-            valid_statuses = ['ok', 'no_amounts_found', 'low_confidence', 'normalization_failed', 'error']
-            if output.status not in valid_statuses:
-                errors.append(f"Status must be one of {valid_statuses}")
-            
-            # Validate amounts
-            for i, amount_info in enumerate(output.amounts):
-                if not isinstance(amount_info.value, (int, float)):
-                    errors.append(f"Amount {i}: value must be a number")
-                
-                if amount_info.value < 0:
-                    errors.append(f"Amount {i}: value cannot be negative")
-                
-                if not amount_info.type:
-                    errors.append(f"Amount {i}: type is required")
-                
-                if not amount_info.source:
-                    errors.append(f"Amount {i}: source is required")
-            
-            # Check for duplicate amounts (might indicate processing errors)
-            amount_values = [amt.value for amt in output.amounts]
-            if len(amount_values) != len(set(amount_values)):
-                logger.warning("Duplicate amounts detected in final output")
-            
-            return len(errors) == 0, errors
-            
-        except Exception as e:
-            errors.append(f"Validation error: {str(e)}")
-            return False, errors
+        # Each field is read from the model once
+        currency, status, amounts = output.currency, output.status, output.amounts
+        
+        # Check required fields
+        if not currency:
+            append("Currency field is required")
+        
+        if not isinstance(amounts, list):
+            append("Amounts must be a list")
+        
+        if not status:
+            append("Status field is required")
+        
+        # Validate currency
+        if currency not in _VALID_CURRENCIES:
+            append(f"Currency must be one of {list(_CURRENCY_CODES)}")
+        
+        # Validate status
+        if status not in _VALID_STATUSES:
+            append(f"Status must be one of {list(_STATUS_CODES)}")
+        
+        # Validate amounts, one sweep per rule; messages are only formatted for
+        # failing amounts
+        extend(
+            f"Amount {i}: value must be a number"
+            for i, amt in enumerate(amounts) if not isinstance(amt.value, (int, float))
+        )
+        extend(
+            f"Amount {i}: value cannot be negative"
+            for i, amt in enumerate(amounts)
+            if isinstance(amt.value, (int, float)) and amt.value < 0
+        )
+        extend(
+            f"Amount {i}: type is required"
+            for i, amt in enumerate(amounts) if not amt.type
+        )
+        extend(
+            f"Amount {i}: source is required"
+            for i, amt in enumerate(amounts) if not amt.source
+        )
+        
+        # Check for duplicate amounts (might indicate processing errors)
+        if _has_duplicates(amt.value for amt in amounts):
+            logger.warning("Duplicate amounts detected in final output")
+        
+        return len(errors) == 0, errors
     
     def create_error_response(self, status: str, reason: str) -> ErrorResponse:
         """Create a standardized error response"""
         
         # Ensure status is valid
-        valid_statuses = ['no_amounts_found', 'low_confidence', 'normalization_failed', 'error']
-        if status not in valid_statuses:
+        if status not in _VALID_ERROR_STATUSES:
             status = 'error'
         
         return ErrorResponse(status=status, reason=reason)
@@ -184,76 +279,59 @@ class UtilityService:
             
         Returns:
             FinalOutput: Following the exact schema from problem statement
-        """
-        try:
-            logger.info(f"Generating final output for {len(classified_amounts)} amounts")
-            
-            amounts_output = []
             
-            for classified_amount in classified_amounts:
-                # Use source from classification if available, otherwise find source context
-                if classified_amount.context and classified_amount.context.startswith("text: '"):
-                    source_context = classified_amount.context
-                else:
-                    # Find source context for provenance
-                    source_context = self.find_source_context(
-                        original_text, 
-                        classified_amount.value
-                    )
-                
-                # Create amount info with source provenance
-                amount_info = AmountInfo(
-                    type=classified_amount.type,
-                    value=classified_amount.value,
-                    source=source_context,
-                    name=classified_amount.name
-                )
-                
-                amounts_output.append(amount_info)
+        Raises:
+            ValueError: If the output does not fit the FinalOutput schema
+        """
+        logger.info("Generating final output for %d amounts", len(classified_amounts))
+        
+        # Source contexts already found for this document, keyed by amount.
+        # Local to the call, so concurrent requests never share entries.
+        context_cache = {}
+        
+        def source_for(classified_amount) -> str:
+            # Use source from classification if available (flagged in step 3),
+            # otherwise find source context
+            if getattr(classified_amount, 'has_source', False):
+                return classified_amount.context
             
-            # Create final output
-            result = FinalOutput(
-                currency=currency,
-                amounts=amounts_output,
-                status="ok"
+            # Find source context for provenance (once per distinct amount)
+            value = classified_amount.value
+            source_context = context_cache.get(value)
+            if source_context is None:
+                source_context = context_cache[value] = find_source_context(original_text, value)
+            return source_context
+        
+        # Create amount info with source provenance
+        amounts_output = [
+            AmountInfo(
+                type=classified_amount.type,
+                value=classified_amount.value,
+                source=source_for(classified_amount),
+                name=classified_amount.name
             )
-            
-            # Validate the output
-            is_valid, validation_errors = self.validate_final_output(result)
-            
-            if not is_valid:
-                logger.error(f"Final output validation failed: {validation_errors}")
-                # Still return the result but log the issues
-                for error in validation_errors:
-                    logger.error(f"Validation error: {error}")
-            
-            logger.info(f"Final output generated successfully with {len(amounts_output)} amounts")
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"Final output generation failed: {e}")
-            raise ValueError(f"Could not generate final output: {str(e)}")
-    
-    def sanitize_text_input(self, text: str) -> str:
-        """Sanitize and clean text input"""
-        if not text:
-            return ""
+            for classified_amount in classified_amounts
+        ]
         
-        # Remove excessive whitespace
-        cleaned = re.sub(r'\s+', ' ', text.strip())
+        # Create final output
+        result = FinalOutput(
+            currency=currency,
+            amounts=amounts_output,
+            status="ok"
+        )
         
-        # Remove any potential harmful characters (basic sanitization)
-        # Keep alphanumeric, common punctuation, and currency symbols
-        cleaned = re.sub(r'[^\w\s.,;:!?₹$€£\-+=%()/@#&]', '', cleaned)
+        # Validate the output
+        is_valid, validation_errors = self.validate_final_output(result)
         
-        # Limit text length to prevent abuse
-        max_length = 10000  # 10KB limit
-        if len(cleaned) > max_length:
-            cleaned = cleaned[:max_length] + "..."
-            logger.warning(f"Input text truncated to {max_length} characters")
+        if not is_valid:
+            logger.error("Final output validation failed: %s", validation_errors)
+            # Still return the result but log the issues
+            for error in validation_errors:
+                logger.error("Validation error: %s", error)
         
-        return cleaned
+        logger.info("Final output generated successfully with %d amounts", len(amounts_output))
         
+        return result
+    
 # Singleton instance
 utility_service = UtilityService()
\ No newline at end of file